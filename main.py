@@ -1,150 +1,425 @@
-import psutil
+import atexit # Making sure buffered log lines land on disk when we quit
 import time
-import datetime
-import logging
-import logging.handlers # Yeah, need this for the rotating logs
 import os
+import queue # Hands the stats over to the log writing thread
+import select # Sleeping in a way that Ctrl+C can cut short
+import signal # Catching Ctrl+C and SIGTERM so we can stop cleanly
+import socket # A little socket pair for Ctrl+C to wake us up through
 import sys # For messing with the terminal output
+import threading # The log gets written from its own thread
+import traceback # For putting the full error in the log
+
+# Quick check: does the user even have psutil?
+try:
+    import psutil
+except ImportError:
+    print("Hold up! You need the 'psutil' library for this script to work.")
+    print("Try running: pip install psutil")
+    sys.exit(1) # Can't do much without it
 
 # --- Stuff you might want to change ---
 LOG_FILE = "system_performance_stats.log" # Where we're saving the detailed stats
-LOG_FORMAT = "%(asctime)s - %(message)s" # Keeping the log format simple: time and the message
-LOG_LEVEL = logging.INFO # INFO level should be good for normal stats
 SAMPLING_INTERVAL_SECONDS = 1  # How often we grab data, 1 second feels pretty live
 MAX_LOG_FILE_SIZE_BYTES = 5 * 1024 * 1024  # Let's keep log files to around 5MB before they roll over
 BACKUP_COUNT = 3  # And keep 3 old ones
+LOG_TO_CONSOLE = False  # Also echo every log line to stderr? Turns the live bars off, the two would garble each other
+LOG_BUFFER_BYTES = 64 * 1024  # Hold up to this much log text in memory and write it out in one go
+LOG_FLUSH_SECS = 10  # ...but never sit on a log line longer than this, so tail -f stays live and a crash loses little
 
 # For the cool terminal bars
 BAR_WIDTH = 35  # How wide the bars look on the screen
 FILLED_CHAR = '❚' # Using a slightly different char for fun
 EMPTY_CHAR = '·' # Light dot for empty part
+STDOUT_FD = 1 # Raw file descriptor for the terminal
+STDERR_FD = 2 # Where log lines get echoed if LOG_TO_CONSOLE is on
+
+# --- Percentages as text ---
+# We only ever show percentages to one decimal, so there are just 1001 of them ("0.0" to "100.0").
+# Make them all once and look them up, instead of float-formatting several per tick.
+_PCT_STRS = [f"{i // 10}.{i % 10}" for i in range(1001)]
+
+def pct_tenths(percentage):
+    # "Rounds a percentage to tenths (0-1000), ready to index _PCT_STRS."
+    tenths = round(percentage * 10)
+    if tenths < 0:
+        return 0
+    if tenths > 1000:
+        return 1000
+    return tenths
 
 # --- Setting up our log file ---
-def setup_file_logger(log_file, log_level, log_format, max_bytes, backup_count):
-    # "Sets up a logger that writes to a file and rotates it when it gets too big."
+# Ticks are a second apart, so the timestamp only needs formatting once per second
+_ts_cache = {"sec": 0, "str": b""}
+
+def log_timestamp(now=None):
+    # "Given time (or right now) the way the log likes it (as bytes), e.g. 2024-05-01 13:37:00"
+    now = int(time.time() if now is None else now)
+    if now != _ts_cache["sec"]:
+        _ts_cache["sec"] = now
+        _ts_cache["str"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)).encode()
+    return _ts_cache["str"]
+
+class FastRotatingLog:
+    # "A tiny log file writer that rotates like RotatingFileHandler, without the logging module."
+    # The logging module builds a LogRecord, runs a Formatter and takes a lock for every
+    # single line. Our lines always look the same, so we just write the bytes ourselves.
+
+    def __init__(self, path, max_bytes, backup_count, buffer_bytes=LOG_BUFFER_BYTES, echo_fd=None,
+                 flush_secs=LOG_FLUSH_SECS):
+        self.path = os.path.abspath(path)
+        self.echo_fd = echo_fd # If set, every line also gets written here straight away
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # Writing one tiny line per second to disk is a lot of little writes.
+        # Buffer them up and flush in batches, once the buffer fills up or its oldest
+        # line has waited flush_secs, whichever comes first; errors still go out straight away.
+        self.buffer_bytes = buffer_bytes
+        self.flush_secs = flush_secs
+        self.pending = bytearray()
+        self.oldest_pending_at = 0.0 # When the oldest line still in the buffer came in
+        self._open()
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+
+    def _rotate(self):
+        # Same shuffle as RotatingFileHandler: log.2 -> log.3, log.1 -> log.2, log -> log.1
+        os.close(self.fd)
+        self.fd = None
+        try:
+            for i in range(self.backup_count - 1, 0, -1):
+                older = f"{self.path}.{i}"
+                if os.path.exists(older):
+                    os.replace(older, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        finally:
+            # Even if a rename failed, get a file open again so we don't write to a closed fd
+            self._open()
+
+    def write(self, line_bytes):
+        # "Queues up one already-formatted line (bytes, ending in a newline)."
+        now = time.monotonic()
+        if not self.pending:
+            self.oldest_pending_at = now
+        # If writes keep failing (disk full for a while), don't let the buffer grow forever:
+        # past twice the normal size, throw away the oldest whole lines (never the new one)
+        overflow = len(self.pending) + len(line_bytes) - 2 * self.buffer_bytes
+        if overflow > 0:
+            cut = self.pending.find(b"\n", overflow - 1)
+            del self.pending[:len(self.pending) if cut < 0 else cut + 1]
+        self.pending += line_bytes
+        if self.echo_fd is not None:
+            try:
+                os.write(self.echo_fd, line_bytes)
+            except OSError:
+                # Console closed or a broken pipe? That's no reason to lose the file log,
+                # just stop echoing (there's nowhere left to complain to anyway)
+                self.echo_fd = None
+        if len(self.pending) >= self.buffer_bytes or now - self.oldest_pending_at >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        # "Writes out whatever's buffered, rotating first if it would push us past the limit."
+        if not self.pending:
+            return
+        if self.fd is None:
+            self._open() # A failed rotation couldn't reopen the file, give it another go
+        # No backups wanted means no rotating at all, same as RotatingFileHandler
+        if (self.backup_count > 0 and self.max_bytes > 0 and self.size > 0
+                and self.size + len(self.pending) > self.max_bytes):
+            self._rotate()
+        # os.write can write less than we asked (e.g. the disk fills up halfway),
+        # so keep going until it's all out, and only drop what actually got written
+        while self.pending:
+            written = os.write(self.fd, self.pending)
+            self.size += written
+            del self.pending[:written]
+
+    def info(self, message):
+        # "Logs a one-off message (not the per-tick stats) with a timestamp."
+        self.write(log_timestamp() + f" - {message}\n".encode('utf-8'))
+
+    def error(self, message, exc_info=False):
+        # "Logs an error, optionally with the current traceback, and writes it out right away."
+        if exc_info:
+            message = f"{message}\n{traceback.format_exc().rstrip()}"
+        self.info(message)
+        self.flush()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        os.close(self.fd)
+        self.fd = None
+
+def setup_file_logger(log_file, max_bytes, backup_count, buffer_bytes=LOG_BUFFER_BYTES, add_console=False,
+                      flush_secs=LOG_FLUSH_SECS):
+    # "Sets up a log file that rotates when it gets too big, optionally echoing to the console too."
     # Make sure the folder for the log file actually exists
     log_dir = os.path.dirname(os.path.abspath(log_file))
     if log_dir and not os.path.exists(log_dir):
         print(f"Log directory {log_dir} doesn't exist, creating it.")
         os.makedirs(log_dir)
 
-    # Get a logger instance, let's name it so it's clear what it's for
-    my_logger = logging.getLogger("PerformanceFileLogger")
-    my_logger.setLevel(log_level)
-    # Stop messages from bubbling up to the root logger, if that's doing something else
-    my_logger.propagate = False
-
-    # This is the handler that writes to our file and handles rotation
-    file_handler = logging.handlers.RotatingFileHandler(
+    file_log = FastRotatingLog(
         log_file,
-        maxBytes=max_bytes,
-        backupCount=backup_count,
-        encoding='utf-8' # Good for handling various characters
+        max_bytes,
+        backup_count,
+        buffer_bytes,
+        echo_fd=STDERR_FD if add_console else None,
+        flush_secs=flush_secs
     )
-    # How each log line should look
-    formatter = logging.Formatter(log_format)
-    file_handler.setFormatter(formatter)
-    my_logger.addHandler(file_handler)
+    # Don't lose whatever's still sitting in the buffer when the script exits
+    atexit.register(file_log.close)
 
-    return my_logger
+    return file_log
+
+# --- Writing the log from a background thread ---
+_BYTES_TO_MB = 1.0 / (1024 * 1024) # Multiplying beats dividing
+def _log_worker(log_queue, file_log, memory_total_mb_str):
+    # "Turns raw stats from the queue into log lines and writes them, until it gets a None."
+    # All the string formatting and file writing happens here, so the sampling loop
+    # only has to grab numbers and drop them in the queue.
+    write_error_reported = False
+    while True:
+        sample = log_queue.get()
+        if sample is None:
+            break
+        timestamp, cpu_usage, memory_percent, memory_used = sample
+        # Let's show used/total memory in MB, it's more human-readable
+        memory_used_mb = memory_used * _BYTES_TO_MB
+        # Making it a bit more like a status update
+        line = log_timestamp(timestamp) + (
+            f" - Tick - CPU: {_PCT_STRS[pct_tenths(cpu_usage)]}%, "
+            f"RAM: {_PCT_STRS[pct_tenths(memory_percent)]}% "
+            f"({memory_used_mb:.1f}/{memory_total_mb_str} MB)\n"
+        ).encode('utf-8')
+        try:
+            file_log.write(line)
+        except OSError as e:
+            # Disk full, file gone, rotation failed... Keep going instead of dying and leaving
+            # the queue piling up. Whatever didn't get written stays buffered for the next try.
+            if not write_error_reported:
+                write_error_reported = True
+                print(f"\nCouldn't write to the log file: {e}. Still monitoring, will keep retrying.",
+                      file=sys.stderr)
+
+# --- Fast RAM readings on Linux ---
+MEMINFO_PATH = "/proc/meminfo"
+
+def open_meminfo(buf):
+    # "Opens /proc/meminfo once so we can re-read it every tick. Returns None if we can't (not Linux)."
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        meminfo_fd = os.open(MEMINFO_PATH, os.O_RDONLY)
+    except OSError:
+        return None # Weird setup? psutil will handle it instead
+    # Old kernels (before 3.14) and some container /proc fakes don't have MemAvailable,
+    # so make sure both fields we need are really there before relying on them
+    try:
+        n = os.preadv(meminfo_fd, [buf], 0)
+        _meminfo_field_bytes(buf, n, b"MemTotal:")
+        _meminfo_field_bytes(buf, n, b"MemAvailable:")
+    except (OSError, ValueError):
+        os.close(meminfo_fd)
+        return None
+    return meminfo_fd
+
+def _meminfo_field_bytes(buf, n, field):
+    # "Digs a single 'Field:   1234 kB' value out of the raw meminfo bytes, in bytes."
+    start = buf.find(field, 0, n)
+    if start < 0:
+        raise ValueError(f"{field.decode()} not found in {MEMINFO_PATH}")
+    start += len(field)
+    end = buf.find(b" kB", start, n)
+    if end < 0:
+        raise ValueError(f"Couldn't read {field.decode()} from {MEMINFO_PATH}")
+    return int(buf[start:end]) * 1024
+
+def read_memory_total(meminfo_fd, buf):
+    # "Total RAM in bytes. It never changes, so we only ask once."
+    if meminfo_fd is None:
+        return psutil.virtual_memory().total
+    n = os.preadv(meminfo_fd, [buf], 0)
+    return _meminfo_field_bytes(buf, n, b"MemTotal:")
+
+def read_memory_used(meminfo_fd, buf, total):
+    # "Used RAM in bytes (total minus what's available), the fast way when we can."
+    if meminfo_fd is None:
+        return total - psutil.virtual_memory().available
+    # One read into the same buffer every time, no file reopen and no namedtuple
+    n = os.preadv(meminfo_fd, [buf], 0)
+    return total - _meminfo_field_bytes(buf, n, b"MemAvailable:")
 
 # --- Helper for making those progress bars ---
-def make_that_bar(percentage, width, filled_char, empty_char):
-    # "Turns a percentage into a text-based progress bar string. Looks neat!"
-    # Just in case the percentage is wild, clamp it between 0 and 100
-    percentage = max(0, min(100, float(percentage)))
-    filled_part_length = int(width * percentage / 100)
-    # Build the bar: some filled chars, then some empty ones
-    bar_itself = filled_char * filled_part_length + empty_char * (width - filled_part_length)
-    return f"[{bar_itself}] {percentage:.1f}%" # Show percentage with one decimal
+# There are only BAR_WIDTH + 1 possible bars, so just build them all once up front.
+# They're already encoded, since they go straight to the terminal as bytes.
+_FILLED_B = FILLED_CHAR.encode('utf-8')
+_EMPTY_B = EMPTY_CHAR.encode('utf-8')
+_BAR_PREFIX = [_FILLED_B * k + _EMPTY_B * (BAR_WIDTH - k) for k in range(BAR_WIDTH + 1)]
+# Same idea for the "] 42.0%" bit after the bar, one per tenth of a percent
+_BAR_SUFFIX = [f"] {pct_str}%".encode() for pct_str in _PCT_STRS]
+
+def make_that_bar(tenths):
+    # "Turns a percentage (in tenths, from pct_tenths) into a text-based progress bar (as bytes). Looks neat!"
+    # Working from the same rounded tenths as the label means the bar can never disagree with it.
+    # pct_tenths already keeps it within 0-1000, so the bar stays inside its box.
+    filled_part_length = tenths * BAR_WIDTH // 1000
+    return b"[" + _BAR_PREFIX[filled_part_length] + _BAR_SUFFIX[tenths] # Show percentage with one decimal
 
 # --- The main show: monitoring and logging! ---
 def watch_and_log(file_logger_instance, update_interval_secs):
     # "This is where the magic happens: grabs stats, logs 'em, shows 'em."
+    # Piped to a file or journalctl? Then the live bars are just garbage, skip them entirely.
+    # Same if log lines are being echoed to the console: they'd land in the middle of the bar line.
+    echoing_log = file_logger_instance.echo_fd is not None
+    render_enabled = sys.stdout.isatty() and not echoing_log
+
     print(f"Alright, starting up! I'll log stats every {update_interval_secs} sec to '{LOG_FILE}'.")
-    print("You'll see live bars below. Press Ctrl+C to stop me.")
+    if render_enabled:
+        print("You'll see live bars below. Press Ctrl+C to stop me.")
+    elif echoing_log:
+        print("Echoing the log lines here instead of live bars. Press Ctrl+C to stop me.")
+    else:
+        print("No terminal attached, so no live bars. Press Ctrl+C to stop me.")
     file_logger_instance.info("Monitoring started.") # Log that we've started
+    # We write the bars straight to the fd later, so get these prints out first
+    sys.stdout.flush()
+
+    # psutil.cpu_percent needs an initial call to start measuring from. With interval=None
+    # it doesn't block; every later interval=None call gives usage since the one before.
+    psutil.cpu_percent(interval=None)
+    time.sleep(0.1) # Just a tiny pause so the first reading covers some real time
+
+    # On Linux we keep /proc/meminfo open and read it straight into this buffer each tick
+    meminfo_buf = bytearray(4096)
+    meminfo_fd = open_meminfo(meminfo_buf)
+
+    # Total RAM won't change while we're running, so work out everything that depends on it now
+    memory_total = read_memory_total(meminfo_fd, meminfo_buf)
+    memory_total_mb_str = f"{memory_total * _BYTES_TO_MB:.1f}"
+    memory_used_to_percent = 100.0 / memory_total
+
+    # When the next tick is due. Sleeping until a fixed deadline (instead of a flat
+    # sleep after the work) stops the time spent on each tick from adding up.
+    next_tick = time.monotonic()
+
+    # What the bars showed last time, in tenths of a percent (that's all the screen shows)
+    last_shown = (-1, -1)
 
-    # psutil.cpu_percent needs an initial call with an interval to start measuring correctly.
-    # After that, interval=None gives usage since the last call.
-    psutil.cpu_percent(interval=0.1)
-    time.sleep(0.1) # Just a tiny pause
+    # Ctrl+C just asks the loop to stop instead of blowing up wherever it happens to be,
+    # so we never leave a half-written line on the terminal or in the log.
+    # SIGTERM (e.g. a service being stopped) does the same, so the log still gets written out.
+    # The handler only notes which signal it was: anything that takes a lock could deadlock in there.
+    stop_requested = [None]
+
+    def request_stop(signum, frame):
+        stop_requested[0] = signum
+
+    # Python pokes a byte into this socket whenever a signal comes in, which wakes up
+    # the select() we sleep in, so Ctrl+C doesn't have to wait for the next tick
+    wake_recv, wake_send = socket.socketpair()
+    wake_recv.setblocking(False)
+    wake_send.setblocking(False)
+    previous_wakeup_fd = signal.set_wakeup_fd(wake_send.fileno())
+    previous_sigint_handler = signal.signal(signal.SIGINT, request_stop)
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, request_stop)
+
+    # From here on the log file belongs to the worker thread, until we stop it
+    log_queue = queue.SimpleQueue()
+    log_worker = threading.Thread(target=_log_worker, args=(log_queue, file_logger_instance, memory_total_mb_str), daemon=True)
+    log_worker.start()
+
+    def stop_log_worker():
+        # "Lets the worker write out everything still queued, then waits for it to finish."
+        if log_worker.is_alive():
+            log_queue.put(None)
+            log_worker.join()
 
     try:
-        while True:
+        while stop_requested[0] is None:
             # Grab CPU usage - non-blocking after the initial setup call
             current_cpu_usage = psutil.cpu_percent(interval=None)
 
             # Get RAM details
-            memory_stats = psutil.virtual_memory()
-            current_memory_percent = memory_stats.percent
-            # Let's show used/total memory in MB, it's more human-readable
-            memory_used_mb = memory_stats.used / (1024 * 1024)
-            memory_total_mb = memory_stats.total / (1024 * 1024)
-
-            # What we're writing to the log file
-            # Making it a bit more like a status update
-            log_entry = (
-                f"Tick - CPU: {current_cpu_usage:.1f}%, "
-                f"RAM: {current_memory_percent:.1f}% "
-                f"({memory_used_mb:.1f}/{memory_total_mb:.1f} MB)"
-            )
-            file_logger_instance.info(log_entry)
+            memory_used = read_memory_used(meminfo_fd, meminfo_buf, memory_total)
+            current_memory_percent = memory_used * memory_used_to_percent
+
+            # Hand the raw numbers to the log thread, it does the formatting and writing
+            log_queue.put_nowait((time.time(), current_cpu_usage, current_memory_percent, memory_used))
 
             # --- Time for the terminal graphics! ---
-            cpu_bar_str = make_that_bar(current_cpu_usage, BAR_WIDTH, FILLED_CHAR, EMPTY_CHAR)
-            mem_bar_str = make_that_bar(current_memory_percent, BAR_WIDTH, FILLED_CHAR, EMPTY_CHAR)
+            if render_enabled:
+                # Nothing visible changed since last tick? Then don't bother redrawing.
+                now_shown = (pct_tenths(current_cpu_usage), pct_tenths(current_memory_percent))
+                if now_shown != last_shown:
+                    last_shown = now_shown
+                    cpu_bar = make_that_bar(now_shown[0])
+                    mem_bar = make_that_bar(now_shown[1])
 
-            # Try to get the terminal width so the line clears properly
-            try:
-                term_width = os.get_terminal_size().columns
-            except OSError: # If it's not a real terminal (e.g., output piped to a file)
-                term_width = 80 # Just guess a standard width
-
-            # The string that'll show up on the terminal
-            # Adding a small space at the end of "CPU" for alignment
-            terminal_display_string = f"CPU : {cpu_bar_str}   RAM : {mem_bar_str}"
-            # Some padding to wipe the previous line's content if it was longer
-            padding_spaces = " " * (term_width - len(terminal_display_string) - 1)
-
-            # \r moves the cursor to the start of the line
-            sys.stdout.write(f"\r{terminal_display_string}{padding_spaces}")
-            sys.stdout.flush() # Make sure it shows up right away
-
-            # Chill for a bit before the next update
-            time.sleep(update_interval_secs)
-
-    except KeyboardInterrupt:
-        # User hit Ctrl+C, let's clean up the terminal line
-        sys.stdout.write("\n")
+                    # The line that'll show up on the terminal, already as bytes.
+                    # \r moves the cursor to the start of the line, \x1b[K wipes whatever
+                    # was left over from a longer previous line, so no padding needed.
+                    terminal_display_line = b"\rCPU : " + cpu_bar + b"   RAM : " + mem_bar + b"\x1b[K"
+                    # Straight to the terminal, skipping sys.stdout's text layer
+                    os.write(STDOUT_FD, terminal_display_line)
+
+            # Chill until the next tick is due
+            next_tick += update_interval_secs
+            delay = next_tick - time.monotonic()
+            if delay <= 0:
+                next_tick = time.monotonic() # We fell behind, start counting from now
+            while delay > 0 and stop_requested[0] is None:
+                # Wakes up early if a signal comes in; if it wasn't Ctrl+C, go back to sleep
+                if select.select([wake_recv], [], [], delay)[0]:
+                    try:
+                        wake_recv.recv(512)
+                    except BlockingIOError:
+                        pass
+                delay = next_tick - time.monotonic()
+
+        # Asked to stop (Ctrl+C or SIGTERM), let's clean up the terminal line
+        if render_enabled:
+            sys.stdout.write("\n")
         print("Okay, okay, I'm stopping! Log file has the history.")
-        file_logger_instance.info("Monitoring stopped by user.")
+        stop_log_worker()
+        if stop_requested[0] == signal.SIGINT:
+            file_logger_instance.info("Monitoring stopped by user.")
+        else:
+            file_logger_instance.info(f"Monitoring stopped by {signal.Signals(stop_requested[0]).name}.")
     except Exception as e:
         # Whoops, something went wrong
-        sys.stdout.write("\n")
+        if render_enabled:
+            sys.stdout.write("\n")
+        stop_log_worker()
         print(f"\nOh no, an error popped up: {e}")
         file_logger_instance.error(f"Bummer, an error happened: {e}", exc_info=True) # Log the full error
     finally:
+        signal.signal(signal.SIGINT, previous_sigint_handler) # Ctrl+C goes back to normal
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+        signal.set_wakeup_fd(previous_wakeup_fd)
+        wake_recv.close()
+        wake_send.close()
         # Just to be sure the cursor is on a new line when we exit
-        sys.stdout.write("\n")
+        if render_enabled:
+            sys.stdout.write("\n")
+        if meminfo_fd is not None:
+            os.close(meminfo_fd)
+        # Push any queued and buffered log lines out to the file
+        stop_log_worker()
+        file_logger_instance.flush()
 
 
 if __name__ == "__main__":
-    # Quick check: does the user even have psutil?
-    try:
-        import psutil
-    except ImportError:
-        print("Hold up! You need the 'psutil' library for this script to work.")
-        print("Try running: pip install psutil")
-        sys.exit(1) # Can't do much without it
-
     # Get our logger ready for action
     my_awesome_file_logger = setup_file_logger(
         LOG_FILE,
-        LOG_LEVEL,
-        LOG_FORMAT,
         MAX_LOG_FILE_SIZE_BYTES,
-        BACKUP_COUNT
+        BACKUP_COUNT,
+        add_console=LOG_TO_CONSOLE
     )
     # And... go!
     watch_and_log(my_awesome_file_logger, SAMPLING_INTERVAL_SECONDS)
\ No newline at end of file